@@ -3,11 +3,21 @@ import json
 import hmac
 import hashlib
 import base64
+import gzip
+import functools
 import os
 import requests
+import threading
 import time
-from datetime import datetime
-from azure.core.exceptions import ResourceNotFoundError
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
+from urllib3.util.retry import Retry
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
 from azure.storage.blob import BlobServiceClient, ContentSettings
 import azure.functions as func 
 
@@ -16,99 +26,161 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 # Cache defaults
 CACHE_CONTAINER = os.getenv("CACHE_CONTAINER", "cache")
-CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "3600"))  # 1 hour
-
-# Whitelisted query-string filters for the large endpoints
-VALID_FILTERS = {
-    "SalesOrders": {
-        "startDate", "endDate",
-        "completedAfter", "completedBefore",
-        "modifiedSince",
-        "customerCode", "customerId",
-        "orderNumber", "orderStatus",
-        "serialBatch", "warehouseCode",
-        "sourceId", "pageSize"
-    },
-    "Invoices": {
-        "customerCode", "startDate", "endDate",
-        "modifiedSince",
-        "invoiceNumber", "invoiceStatus",
-        "orderNumber", "serialBatch",
-        "pageSize"
-    }
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "3600"))  # 1 hour; 0 disables caching
+
+# Upper bound on pages fetched concurrently from Unleashed
+MAX_PAGE_WORKERS = max(1, int(os.getenv("MAX_PAGE_WORKERS", "8")))
+
+
+class EndpointPolicy(NamedTuple):
+    """How the proxy treats one Unleashed endpoint."""
+    filters: Optional[frozenset] = None  # whitelisted query params; None passes all through
+    lines_key: Optional[str] = None      # flatten to one record per line of this collection
+    max_workers: int = MAX_PAGE_WORKERS
+
+
+# Unleashed collections exposed by the proxy as /api/Unleashed<Endpoint>
+ENDPOINTS = {
+    # Slow Unleashed backends under parallel load get fewer page workers
+    "StockOnHand": EndpointPolicy(max_workers=4),
+    "Products": EndpointPolicy(max_workers=4),
+    "Customers": EndpointPolicy(),
+    "SalesOrders": EndpointPolicy(
+        filters=frozenset({
+            "startDate", "endDate",
+            "completedAfter", "completedBefore",
+            "modifiedSince",
+            "customerCode", "customerId",
+            "orderNumber", "orderStatus",
+            "serialBatch", "warehouseCode",
+            "sourceId", "pageSize"
+        }),
+        lines_key="SalesOrderLines"
+    ),
+    "Invoices": EndpointPolicy(
+        filters=frozenset({
+            "customerCode", "startDate", "endDate",
+            "modifiedSince",
+            "invoiceNumber", "invoiceStatus",
+            "orderNumber", "serialBatch",
+            "pageSize"
+        }),
+        lines_key="InvoiceLines"
+    ),
+    "CreditNotes": EndpointPolicy(),
+    "PurchaseOrders": EndpointPolicy(),
+}
+# Functions route matching ignores case, so resolve names the same way
+_ENDPOINT_NAMES = {name.lower(): name for name in ENDPOINTS}
+# Worker-wide cap on requests in flight to each slow backend, so overlapping
+# pulls cannot stack more than max_workers requests on it between them
+_ENDPOINT_SLOTS = {
+    name: threading.BoundedSemaphore(policy.max_workers)
+    for name, policy in ENDPOINTS.items()
+    if policy.max_workers < MAX_PAGE_WORKERS
 }
 
+# In-process cache in front of the blob cache (warm workers serve repeats from RAM)
+MEMORY_CACHE_MAX_ENTRIES = 128
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("MEMORY_CACHE_MAX_MB", "256")) * 1024 * 1024
+_memory_cache = OrderedDict()  # key -> (expires_at monotonic, payload bytes)
+_memory_cache_bytes = 0
+_memory_cache_lock = threading.Lock()
 
-# Define your HTTP-triggered routes
-@app.route(route="UnleashedStockOnHand")
-def unleashed_stock_on_hand(req: func.HttpRequest) -> func.HttpResponse:
-    return call_unleashed_api(req, "StockOnHand")
+_json_encoder = json.JSONEncoder(separators=(",", ":"))
 
+# Hard cap on an assembled response body; keeps large pulls from OOMing the worker.
+# A pull peaks at about twice this (page fragments plus the joined body)
+MAX_RESPONSE_BYTES = int(os.getenv("MAX_RESPONSE_MB", "512")) * 1024 * 1024
 
-@app.route(route="UnleashedCustomers")
-def unleashed_customers(req: func.HttpRequest) -> func.HttpResponse:
-    return call_unleashed_api(req, "Customers")
+# Responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
 
+# Upstream error bodies are truncated to this many bytes when relayed
+ERROR_BODY_MAX_BYTES = 512
 
-@app.route(route="UnleashedProducts")
-def unleashed_products(req: func.HttpRequest) -> func.HttpResponse:
-    return call_unleashed_api(req, "Products")
+# Keep-alive session to Unleashed, shared by all invocations in this worker.
+# The pool must hold the connections of every overlapping pull, not just one,
+# or the surplus is closed on return and the next pull re-handshakes
+UNLEASHED_POOL_SIZE = max(MAX_PAGE_WORKERS, int(os.getenv("UNLEASHED_POOL_SIZE", "32")))
+_session = None
+_session_lock = threading.Lock()
 
+# Last NumberOfPages seen per cache key, so a refetch can fan out from page 1
+PAGE_COUNT_HINTS_MAX = 1024
+_page_counts = OrderedDict()
+_page_counts_lock = threading.Lock()
 
-@app.route(route="UnleashedSalesOrders")
-def unleashed_sales_orders(req: func.HttpRequest) -> func.HttpResponse:
-    return call_unleashed_api(req, "SalesOrders")
+# Cache misses currently being fetched: key -> Future of the response body
+_inflight = {}
+_inflight_guard = threading.Lock()
 
+# Outbound request budget to Unleashed per worker (0 disables pacing)
+UNLEASHED_MAX_RPS = float(os.getenv("UNLEASHED_MAX_RPS", "10"))
+# Back off when Unleashed reports fewer requests than this left in its window
+RATE_LIMIT_LOW_WATER = 5
+# Longest server-requested wait honoured before a page request continues
+RETRY_AFTER_MAX_SECONDS = 60.0
 
-@app.route(route="UnleashedInvoices")
-def unleashed_invoices(req: func.HttpRequest) -> func.HttpResponse:
-    return call_unleashed_api(req, "Invoices")
+# Cache container client, built once per worker process
+_cache_container = None
+_cache_container_lock = threading.Lock()
 
 
-@app.route(route="UnleashedCreditNotes")
-def unleashed_credit_notes(req: func.HttpRequest) -> func.HttpResponse:
-    return call_unleashed_api(req, "CreditNotes")
+# Single HTTP-triggered route; the endpoint comes from the URL
+@app.route(route="Unleashed{endpoint:alpha}")
+def unleashed_endpoint(req: func.HttpRequest) -> func.HttpResponse:
+    name = req.route_params.get("endpoint", "")
+    endpoint = _ENDPOINT_NAMES.get(name.lower())
+    if endpoint is None:
+        return func.HttpResponse(f"Unknown Unleashed endpoint: {name}", status_code=404)
+    return call_unleashed_api(req, endpoint)
 
 
-@app.route(route="UnleashedPurchaseOrders")
-def unleashed_purchase_orders(req: func.HttpRequest) -> func.HttpResponse:
-    return call_unleashed_api(req, "PurchaseOrders")
+@functools.lru_cache(maxsize=4)
+def _hmac_template(api_key: str):
+    # Keyed once per API key; copies skip re-deriving the inner/outer pads
+    return hmac.new(api_key.encode("utf-8"), digestmod=hashlib.sha256)
 
 
 def generate_signature(api_key: str, query_string: str) -> str:
     """Generate the HMAC-SHA256 signature per Unleashed API spec."""
-    message = query_string.encode("utf-8")
-    secret = api_key.encode("utf-8")
-    digest = hmac.new(secret, message, hashlib.sha256).digest()
-    return base64.b64encode(digest).decode()
+    mac = _hmac_template(api_key).copy()
+    mac.update(query_string.encode("utf-8"))
+    return base64.b64encode(mac.digest()).decode()
 
 
-def flatten_sales_orders(orders: list) -> list:
-    """Flatten SalesOrders into one record per SalesOrderLine."""
+def _flatten_lines(records: list, lines_key: str) -> list:
+    """One output record per line, header fields merged under line fields."""
     flat = []
-    for order in orders:
-        header = {k: v for k, v in order.items() if k != "SalesOrderLines"}
-        for line in order.get("SalesOrderLines", []):
-            rec = header.copy()
-            rec.update(line)
-            flat.append(rec)
-    logging.info(f"Flattened {len(orders)} orders -> {len(flat)} lines.")
+    extend = flat.extend
+    for header in records:
+        # Popped in place, leaving the header; Unleashed sends null as well
+        # as [] for records without lines
+        lines = header.pop(lines_key, None)
+        if not lines:
+            continue
+        extend([header | line for line in lines])
     return flat
 
 
-def flatten_sales_invoices(invoices: list) -> list:
-    """Flatten Invoices into one record per InvoiceLine."""
-    flat = []
-    for inv in invoices:
-        header = {k: v for k, v in inv.items() if k != "InvoiceLines"}
-        for line in inv.get("InvoiceLines", []):
-            rec = header.copy()
-            rec.update(line)
-            flat.append(rec)
-    logging.info(f"Flattened {len(invoices)} invoices -> {len(flat)} lines.")
+def flatten_items(lines_key: Optional[str], items: list) -> list:
+    """Flatten a page to one record per line of lines_key; None passes through."""
+    if lines_key is None:
+        return items
+    flat = _flatten_lines(items, lines_key)
+    logging.debug(f"Flattened {len(items)} records -> {len(flat)} {lines_key}.")
     return flat
 
 
+def encode_items(items: list) -> bytes:
+    """Compact JSON for a list of records, without the enclosing brackets."""
+    if not isinstance(items, list):
+        # Stripping the first and last byte only makes sense for "[...]"
+        raise TypeError(f"expected a list of records, got {type(items).__name__}")
+    return _json_encoder.encode(items).encode("utf-8")[1:-1]
+
+
 def _blob_service_client() -> BlobServiceClient:
     conn = os.getenv("AzureWebJobsStorage")
     if not conn:
@@ -116,56 +188,137 @@ def _blob_service_client() -> BlobServiceClient:
     return BlobServiceClient.from_connection_string(conn)
 
 
-def _cache_blob_client(endpoint: str, filters: dict):
-    key = f"{endpoint}?" + "&".join(f"{k}={filters[k]}" for k in sorted(filters))
-    key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+def _cache_container_client():
+    """Return the cache container, creating it on first use in this process."""
+    global _cache_container
+    if _cache_container is None:
+        with _cache_container_lock:
+            if _cache_container is None:
+                container = _blob_service_client().get_container_client(CACHE_CONTAINER)
+                try:
+                    container.create_container()
+                except ResourceExistsError:
+                    pass
+                except Exception as exc:
+                    # No create permission is fine if the container exists
+                    logging.warning(f"Cache container create failed: {exc}")
+                _cache_container = container
+    return _cache_container
+
+
+def _cache_blob_client(endpoint: str, key: str):
+    key_hash = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
     blob_name = f"{endpoint}/{key_hash}.json"
-    service = _blob_service_client()
-    container = service.get_container_client(CACHE_CONTAINER)
+    return _cache_container_client().get_blob_client(blob_name)
+
+
+def _page_count_hint(key: str) -> int:
+    with _page_counts_lock:
+        return _page_counts.get(key, 1)
+
+
+def _remember_page_count(key: str, pages: int):
+    with _page_counts_lock:
+        _page_counts[key] = pages
+        _page_counts.move_to_end(key)
+        while len(_page_counts) > PAGE_COUNT_HINTS_MAX:
+            _page_counts.popitem(last=False)
+
+
+def _memory_cache_get(key: str):
+    with _memory_cache_lock:
+        entry = _memory_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, payload = entry
+        if expires_at <= time.monotonic():
+            _memory_cache_evict(key)
+            return None
+        _memory_cache.move_to_end(key)
+        return payload
+
+
+def _memory_cache_put(key: str, payload: bytes, ttl: float):
+    global _memory_cache_bytes
+    if ttl <= 0 or len(payload) > MEMORY_CACHE_MAX_BYTES:
+        return
+    with _memory_cache_lock:
+        _memory_cache_evict(key)
+        _memory_cache[key] = (time.monotonic() + ttl, payload)
+        _memory_cache_bytes += len(payload)
+        while (len(_memory_cache) > MEMORY_CACHE_MAX_ENTRIES
+               or _memory_cache_bytes > MEMORY_CACHE_MAX_BYTES):
+            _memory_cache_evict(next(iter(_memory_cache)))
+
+
+def _memory_cache_evict(key: str):
+    # Caller holds _memory_cache_lock
+    global _memory_cache_bytes
+    entry = _memory_cache.pop(key, None)
+    if entry is not None:
+        _memory_cache_bytes -= len(entry[1])
+
+
+def _within_cache_ttl(timestamp: Optional[str]) -> bool:
+    """True if an ISO timestamp (e.g. modifiedSince) is newer than now - TTL.
+
+    Naive values are taken as UTC; anything unparseable counts as False.
+    """
+    if not timestamp:
+        return False
     try:
-        container.create_container()
-    except Exception:
-        # Likely already exists or no permission; ignore
-        pass
-    return container.get_blob_client(blob_name), key
+        when = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when > datetime.now(timezone.utc) - timedelta(seconds=CACHE_TTL_SECONDS)
 
 
-def try_get_cached_payload(endpoint: str, filters: dict):
+def try_get_cached_payload(endpoint: str, key: str):
     """Return cached payload if it exists and is still fresh."""
+    payload = _memory_cache_get(key)
+    if payload is not None:
+        logging.info(f"Memory cache hit for {key}")
+        return payload
+
     try:
-        blob_client, key = _cache_blob_client(endpoint, filters)
+        blob_client = _cache_blob_client(endpoint, key)
     except Exception as exc:
         logging.warning(f"Cache disabled (init failed): {exc}")
         return None
 
+    # One conditional GET: Storage answers 304 when the blob is older than the TTL
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(seconds=CACHE_TTL_SECONDS)
     try:
-        props = blob_client.get_blob_properties()
+        downloader = blob_client.download_blob(if_modified_since=cutoff)
+        data = downloader.readall()
     except ResourceNotFoundError:
         return None
-    except Exception as exc:
-        logging.warning(f"Cache probe failed: {exc}")
-        return None
-
-    if props.last_modified is None:
-        return None
-    age = datetime.utcnow() - props.last_modified.replace(tzinfo=None)
-    if age.total_seconds() > CACHE_TTL_SECONDS:
-        logging.info(f"Cache stale for {key}")
+    except HttpResponseError as exc:
+        if exc.status_code == 304:
+            logging.info(f"Cache stale for {key}")
+        else:
+            logging.warning(f"Cache read failed: {exc}")
         return None
-
-    try:
-        data = blob_client.download_blob().readall()
-        logging.info(f"Cache hit for {key}")
-        return data
     except Exception as exc:
         logging.warning(f"Cache read failed: {exc}")
         return None
 
+    logging.info(f"Cache hit for {key}")
+    last_modified = downloader.properties.last_modified
+    if last_modified is not None:
+        _memory_cache_put(key, data, (last_modified - cutoff).total_seconds())
+    return data
+
 
-def write_cache_payload(endpoint: str, filters: dict, payload: bytes):
+def write_cache_payload(endpoint: str, key: str, payload: bytes):
     """Write payload to cache; failures are non-fatal."""
+    _memory_cache_put(key, payload, CACHE_TTL_SECONDS)
+
     try:
-        blob_client, key = _cache_blob_client(endpoint, filters)
+        blob_client = _cache_blob_client(endpoint, key)
     except Exception as exc:
         logging.warning(f"Cache disabled (init failed): {exc}")
         return
@@ -181,15 +334,197 @@ def write_cache_payload(endpoint: str, filters: dict, payload: bytes):
         logging.warning(f"Cache write failed: {exc}")
 
 
+class _CappedRetry(Retry):
+    """Retry that honours Retry-After, but never for longer than RETRY_AFTER_MAX_SECONDS."""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, RETRY_AFTER_MAX_SECONDS)
+
+
+def _unleashed_session() -> requests.Session:
+    """Return the pooled Unleashed session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = _CappedRetry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=(429, 502, 503, 504),
+                    allowed_methods=("GET",),
+                    raise_on_status=False  # hand the last response back to the caller
+                )
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_maxsize=UNLEASHED_POOL_SIZE, max_retries=retry))
+                _session = session
+    return _session
+
+
+def fetch_page(session: requests.Session, base_url: str, page: int,
+               headers: dict, qs: str, slots=nullcontext()) -> requests.Response:
+    """GET a single page; Unleashed takes the page number as a path segment."""
+    url = f"{base_url}/{page}" if page > 1 else base_url
+    with slots:
+        _rate_limiter.acquire()
+        resp = session.get(f"{url}?{qs}", headers=headers, timeout=180)
+    _throttle_from_headers(resp)
+    return resp
+
+
+def _throttle_from_headers(resp: requests.Response):
+    # Pause every page worker only when Unleashed says its quota is nearly
+    # spent, or is already refusing requests (a 429 that outlived the retries)
+    remaining = resp.headers.get("X-RateLimit-Remaining", "")
+    if resp.status_code != 429 and (
+            not remaining.isdecimal() or int(remaining) >= RATE_LIMIT_LOW_WATER):
+        return
+    delay = min(_rate_limit_delay(resp.headers), RETRY_AFTER_MAX_SECONDS)
+    state = f"{remaining} left" if remaining else f"HTTP {resp.status_code}"
+    logging.warning(f"Unleashed rate limit nearly spent ({state}); pausing {delay:g}s")
+    _rate_limiter.pause(delay)
+
+
+def _rate_limit_delay(headers) -> float:
+    """Seconds until Unleashed accepts requests again: Retry-After, else
+    X-RateLimit-Reset (seconds or a Unix timestamp), else 1."""
+    for name in ("Retry-After", "X-RateLimit-Reset"):
+        try:
+            value = float(headers.get(name, ""))
+        except ValueError:
+            continue  # absent, or an HTTP-date not worth parsing for a short pause
+        if value > 1e9:
+            value -= time.time()
+        return max(value, 0.0)
+    return 1.0
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks only when the budget is spent
+    or while a pause() requested by the server is in effect."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.resume_at - now
+                if wait <= 0:
+                    if self.rate <= 0:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+
+_rate_limiter = TokenBucket(UNLEASHED_MAX_RPS)
+
+
+class UnleashedPageError(Exception):
+    """An Unleashed page request came back with a non-200 status."""
+
+    def __init__(self, endpoint: str, page: int, resp: requests.Response):
+        super().__init__(f"{endpoint} page {page} failed: {resp.status_code}")
+        self.endpoint = endpoint
+        self.page = page
+        self.resp = resp
+
+
+class PayloadTooLargeError(Exception):
+    """The assembled response would exceed MAX_RESPONSE_BYTES."""
+
+
+def single_flight(key: str, fetch):
+    """Run fetch() once per cache key at a time and share its outcome.
+
+    Callers arriving while a pull for the same key is running wait for it
+    and get its body, or its exception re-raised. Returns (body, shared),
+    shared being True for the callers that waited.
+    """
+    with _inflight_guard:
+        flight = _inflight.get(key)
+        shared = flight is not None
+        if not shared:
+            flight = _inflight[key] = Future()
+    if shared:
+        return flight.result(), True
+    try:
+        flight.set_result(fetch())
+    except BaseException as exc:
+        flight.set_exception(exc)
+    finally:
+        with _inflight_guard:
+            del _inflight[key]
+    return flight.result(), False
+
+
+def page_error_response(endpoint: str, page: int, resp: requests.Response) -> func.HttpResponse:
+    """Log a failed page fetch and relay the upstream status to the caller."""
+    # Only the head of the body is kept; resp.text would decode (and
+    # charset-sniff) the whole thing just to be truncated in a log line
+    detail = resp.content[:ERROR_BODY_MAX_BYTES].decode("utf-8", "replace")
+    logging.error(f"{endpoint} page {page} failed: {resp.status_code} {detail}")
+    return func.HttpResponse(
+        f"Error fetching {endpoint} page {page}: {detail}",
+        status_code=resp.status_code
+    )
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """True if Accept-Encoding allows gzip; q=0 (explicit or via *) refuses it."""
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        coding, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    return weights.get("gzip", weights.get("*", 0.0)) > 0
+
+
+def json_response(req: func.HttpRequest, body: bytes, cache_status: str) -> func.HttpResponse:
+    """200 JSON response, gzip-compressed when the client accepts it.
+
+    cache_status ("HIT"/"MISS") is echoed in X-Cache for observability.
+    """
+    headers = {"Vary": "Accept-Encoding", "X-Cache": cache_status}
+    accept = req.headers.get("Accept-Encoding", "")
+    if len(body) >= GZIP_MIN_BYTES and _accepts_gzip(accept):
+        # Level 1: JSON still shrinks ~5-10x and CPU stays off the critical path
+        body = gzip.compress(body, compresslevel=1, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    return func.HttpResponse(body, status_code=200, headers=headers, mimetype="application/json")
+
+
 def call_unleashed_api(req: func.HttpRequest, endpoint: str) -> func.HttpResponse:
     """
     1. Strip Azure ?code param
     2. Whitelist only valid filters
-    3. Page through the Unleashed API
+    3. Serve from cache, or page through the Unleashed API (fetch_payload)
     4. Flatten SalesOrders & Invoices
     5. Return JSON {"Items": [...]}
     """
-    logging.info(f"Entering call_unleashed_api for {endpoint}")
+    logging.debug(f"Entering call_unleashed_api for {endpoint}")
     api_id = os.getenv("UNLEASHED_API_ID")
     api_key = os.getenv("UNLEASHED_API_KEY")
     if not api_id or not api_key:
@@ -199,74 +534,149 @@ def call_unleashed_api(req: func.HttpRequest, endpoint: str) -> func.HttpRespons
         )
 
     # 1. Prepare filters
+    policy = ENDPOINTS[endpoint]
     raw = req.params.copy()
     raw.pop("code", None)  # drop Azure function key
-    filters = {
-        k: v
-        for k, v in raw.items()
-        if endpoint not in VALID_FILTERS or k in VALID_FILTERS[endpoint]
-    }
+    # raw is already a private copy, so pass-through endpoints use it as is
+    allowed = policy.filters
+    filters = raw if allowed is None else {k: v for k, v in raw.items() if k in allowed}
+    # An incremental pull reaching back less than the TTL wants changes newer
+    # than a cached copy could hold, so it always goes to Unleashed
+    use_cache = CACHE_TTL_SECONDS > 0 and not _within_cache_ttl(filters.get("modifiedSince"))
     # always request max pageSize
     if "pageSize" not in filters:
         filters["pageSize"] = "1000"
+    elif not filters["pageSize"].isdecimal() or int(filters["pageSize"]) < 1:
+        # Reject before signing anything or calling Unleashed
+        return func.HttpResponse(
+            f"pageSize must be a positive integer, got {filters['pageSize']!r}",
+            status_code=400
+        )
 
-    # Build the sorted query string for signing
-    qs = "&".join(f"{k}={filters[k]}" for k in sorted(filters))
+    # Canonical query: sorted once. The signature covers the unencoded
+    # pairs, the form this proxy has always signed against Unleashed;
+    # the wire copy is URL-encoded from the same pairs exactly as requests
+    # encodes params= (spaces as "+") and sent verbatim
+    pairs = sorted(filters.items())
+    signed_qs = "&".join(f"{k}={v}" for k, v in pairs)
+    qs = urlencode(pairs)
+    # The same canonical string keys both cache layers
+    key = f"{endpoint}?{qs}"
 
     # Short-circuit if we already have a fresh cached payload
-    cached = try_get_cached_payload(endpoint, filters)
-    if cached is not None:
+    if use_cache:
+        cached = try_get_cached_payload(endpoint, key)
+        if cached is not None:
+            return json_response(req, cached, "HIT")
+
+    def pull() -> bytes:
+        body = fetch_payload(endpoint, api_id, api_key, qs, signed_qs)
+        # Persist to cache for the next overlapping call
+        if use_cache:
+            write_cache_payload(endpoint, key, body)
+        return body
+
+    # Concurrent misses for the same filters share a single upstream pull
+    try:
+        body, shared = single_flight(key, pull)
+    except UnleashedPageError as exc:
+        return page_error_response(exc.endpoint, exc.page, exc.resp)
+    except PayloadTooLargeError as exc:
+        logging.error(str(exc))
         return func.HttpResponse(
-            cached,
-            status_code=200,
-            headers={"Content-Type": "application/json"}
+            f"{exc}; narrow the filters (e.g. a shorter date range)",
+            status_code=413
         )
 
-    # 2. Pagination loop
-    all_items = []
-    page = 1
-    base_url = f"https://api.unleashedsoftware.com/{endpoint}"
-    while True:
-        sig = generate_signature(api_key, qs)
-        headers = {
-            "api-auth-id": api_id,
-            "api-auth-signature": sig,
-            "Accept": "application/json"
-        }
-        url = f"{base_url}/{page}" if page > 1 else base_url
-        resp = requests.get(url, headers=headers, params=filters, timeout=180)
-        if resp.status_code != 200:
-            logging.error(f"{endpoint} page {page} failed: {resp.status_code} {resp.text}")
-            return func.HttpResponse(
-                f"Error fetching {endpoint} page {page}: {resp.text}",
-                status_code=resp.status_code
-            )
-        data = resp.json()
-        items = data.get("Items", [])
-        if not items:
-            break
-        all_items.extend(items)
-        if len(items) < int(filters["pageSize"]):
-            break
-        page += 1
-        time.sleep(0.1)
-
-    # 3. Flatten large collections
-    result = all_items
-    if endpoint == "SalesOrders":
-        result = flatten_sales_orders(all_items)
-    elif endpoint == "Invoices":
-        result = flatten_sales_invoices(all_items)
-
-    # 4. Return
-    payload = {"Items": result}
-    body = json.dumps(payload).encode("utf-8")
-
-    # Persist to cache for the next overlapping call
-    write_cache_payload(endpoint, filters, body)
+    # A shared pull only counts as a hit when this request could have been
+    # served from cache; otherwise nothing came from one
+    return json_response(req, body, "HIT" if shared and use_cache else "MISS")
 
-    return func.HttpResponse(
-        body,
-        status_code=200,
-        headers={"Content-Type": "application/json"}
+
+def fetch_payload(endpoint: str, api_id: str, api_key: str, qs: str, signed_qs: str) -> bytes:
+    """Pull every page of an endpoint and return the {"Items": [...]} JSON body.
+
+    qs is the URL-encoded query sent with every page; signed_qs is the same
+    sorted query unencoded, the form the signature is computed over.
+
+    Page 1 reports NumberOfPages; the rest are fetched concurrently over the
+    worker's pooled keep-alive session. If an earlier pull of the same query
+    saw N pages, up to one round of workers' worth of them is requested with
+    page 1, and page 1's Pagination still decides which of them are used. Raises
+    UnleashedPageError on the first failed page and PayloadTooLargeError once
+    the body would pass MAX_RESPONSE_BYTES.
+    """
+    started = time.monotonic()
+    key = f"{endpoint}?{qs}"
+    base_url = f"https://api.unleashedsoftware.com/{endpoint}"
+    headers = {
+        "api-auth-id": api_id,
+        "api-auth-signature": generate_signature(api_key, signed_qs),
+        "Accept": "application/json"
+    }
+    session = _unleashed_session()
+    policy = ENDPOINTS[endpoint]
+    workers = min(MAX_PAGE_WORKERS, policy.max_workers)
+    slots = _ENDPOINT_SLOTS.get(endpoint, nullcontext())
+    # Each page is flattened and encoded as soon as it arrives, so only
+    # compact JSON bytes are held, never every record as Python dicts
+    fragments = []
+    size = 0
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(page):
+        return executor.submit(fetch_page, session, base_url, page, headers, qs, slots)
+
+    # Speculate at most one round of workers from the hint, so a failing
+    # page 1 (401/403/429) or a stale hint wastes only a few requests
+    expected = min(_page_count_hint(key), workers)
+    futures = deque(submit(page) for page in range(1, expected + 1))
+    try:
+        # Consume in page order so the output ordering is unchanged;
+        # popping drops each response as soon as it has been used
+        page, total_pages = 0, 1
+        while page < total_pages:
+            page += 1
+            resp = futures.popleft().result()
+            if resp.status_code != 200:
+                raise UnleashedPageError(endpoint, page, resp)
+            data = json.loads(resp.content)
+            if page == 1:
+                total_pages = int((data.get("Pagination") or {}).get("NumberOfPages") or 1)
+                futures.extend(submit(p) for p in range(expected + 1, total_pages + 1))
+            # Unleashed sends "Items": null as well as [] for an empty page
+            items = flatten_items(policy.lines_key, data.get("Items") or [])
+            fragments.append(encode_items(items))
+            del items, data
+            size += len(fragments[-1])
+            if size > MAX_RESPONSE_BYTES:
+                raise PayloadTooLargeError(
+                    f"{endpoint} response exceeded {MAX_RESPONSE_BYTES} bytes at page {page}"
+                )
+    finally:
+        # Pages past NumberOfPages (stale hint) or after a failure: queued
+        # ones are dropped, and ones already in flight are not waited for
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    _remember_page_count(key, total_pages)
+    # One summary record per pull instead of per-page chatter; the counts
+    # also go in extra so App Insights indexes them without parsing the text
+    elapsed = time.monotonic() - started
+    logging.info(
+        f"Fetched {endpoint}: {total_pages} pages, {size} bytes in {elapsed:.2f}s",
+        extra={"endpoint": endpoint, "pages": total_pages, "bytes": size, "elapsed": round(elapsed, 3)}
     )
+    # Envelope, commas and fragments go through a single join, so the body
+    # is copied once while the fragments are alive rather than three times
+    parts = [b'{"Items":[']
+    for fragment in fragments:
+        if fragment:
+            parts += (fragment, b",")
+    if len(parts) > 1:
+        parts.pop()  # trailing comma
+    parts.append(b"]}")
+    del fragments
+    body = b"".join(parts)
+    del parts
+    return body